@@ -1,103 +1,284 @@
 from __future__ import annotations
 
+import atexit
+import itertools
 import json
 import logging
-import secrets
+import os
+import queue
+import random
+import sys
+import tempfile
+import threading
 import time
-from datetime import datetime, timezone
-from logging.handlers import RotatingFileHandler
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
 from pathlib import Path
-from flask import Flask, render_template, jsonify, g, request
+from flask import Flask, Response, render_template, jsonify, g, request, session
+from flask.wrappers import Request
+from jinja2 import FileSystemBytecodeCache
 
 from . import db as db_module
-from .auth import bp as auth_bp
-from .courses import bp as courses_bp
-from .lessons import bp as lessons_bp
-from .notices import bp as notices_bp
-from .assignments import bp as assignments_bp
-from .security import login_required
+from .security import login_required, init_app as init_security
 from .migrate import register_cli as register_migrate_cli  # <<< NOVO
 
+try:  # opcional: parser em C que aceita bytes direto
+    import orjson
+    _json_loads = orjson.loads
+except ImportError:
+    _json_loads = json.loads
+
 VERSION = "0.12.0"
 
+# cache de config/secret por (caminho, mtime, tamanho): chamadas repetidas a
+# create_app() no mesmo processo (testes, app factories) não relêem os arquivos
+_CFG_CACHE: dict[tuple, object] = {}
+
+def _cache_key(path: Path) -> tuple:
+    st = path.stat()
+    return (str(path), st.st_mtime_ns, st.st_size)
+
 def _load_json_config(config_path: Path) -> dict:
     default = {"site_name": "IpêLMS", "environment": "development"}
     try:
-        data = json.loads(config_path.read_text(encoding="utf-8"))
+        key = _cache_key(config_path)
+        if key in _CFG_CACHE:
+            return dict(_CFG_CACHE[key])
+        data = _json_loads(config_path.read_bytes())
         if not isinstance(data, dict):
             return default
         data.setdefault("site_name", "IpêLMS")
         data.setdefault("environment", "development")
-        return data
+        _CFG_CACHE[key] = data
+        return dict(data)
     except Exception:
         return default
 
 def _load_secret_key(secret_path: Path) -> str:
     try:
-        key = secret_path.read_text(encoding="utf-8").strip()
-        return key if len(key) >= 32 else "dev"
+        key = _cache_key(secret_path)
+        if key in _CFG_CACHE:
+            return _CFG_CACHE[key]
+        secret = secret_path.read_text(encoding="utf-8").strip()
+        secret = secret if len(secret) >= 32 else "dev"
+        _CFG_CACHE[key] = secret
+        return secret
     except Exception:
         return "dev"
 
+# diretórios já garantidos neste processo (evita mkdir a cada create_app)
+_DIRS_READY: set[str] = set()
+
 def _setup_dirs(root: Path) -> dict[str, Path]:
     paths = {
         "LOG_DIR": root / "logs",
         "UPLOADS_DIR": root / "uploads",
         "INSTANCE_DIR": root / "instance",
+        "JINJA_CACHE_DIR": root / "instance" / "jinja_cache",
         "CONFIG_JSON": root / "config" / "config.json",
         "SECRET_FILE": root / "config" / "secret_key.txt",
         "APP_LOG": root / "logs" / "app.log",
         "ACCESS_LOG": root / "logs" / "access.log",
     }
-    paths["LOG_DIR"].mkdir(parents=True, exist_ok=True)
-    paths["UPLOADS_DIR"].mkdir(parents=True, exist_ok=True)
-    paths["INSTANCE_DIR"].mkdir(parents=True, exist_ok=True)
+    for k in ("LOG_DIR", "UPLOADS_DIR", "INSTANCE_DIR", "JINJA_CACHE_DIR"):
+        p = str(paths[k])
+        if p in _DIRS_READY:
+            continue
+        if not os.path.isdir(p):
+            os.makedirs(p, exist_ok=True)
+        _DIRS_READY.add(p)
     return paths
 
+def _queued(handler: logging.Handler) -> QueueHandler:
+    """escrita em disco numa thread de fundo; o request só enfileira o record"""
+    q: queue.SimpleQueue = queue.SimpleQueue()
+    listener = QueueListener(q, handler, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+    return QueueHandler(q)
+
+class _BufferedRotatingFileHandler(RotatingFileHandler):
+    """RotatingFileHandler com buffer de 32 KiB.
+    Só faz flush em WARNING+, a cada `flush_interval` segundos ou ao fechar.
+    """
+
+    def __init__(self, *args, flush_interval: float = 30.0, **kwargs):
+        self._size = 0
+        super().__init__(*args, **kwargs)
+        self._stop = threading.Event()
+        t = threading.Thread(target=self._flush_loop, args=(flush_interval,),
+                             name="ipelms-log-flush", daemon=True)
+        t.start()
+
+    def _open(self):
+        # binário: a linha é codificada uma vez só no emit e o tamanho sai em bytes
+        stream = open(self.baseFilename, self.mode + "b", buffering=32768)
+        self._size = stream.seek(0, os.SEEK_END)
+        return stream
+
+    def _flush_loop(self, interval: float) -> None:
+        while not self._stop.wait(interval):
+            self.flush()
+
+    def emit(self, record) -> None:
+        try:
+            # formata uma vez; o tamanho (contado em memória, sem seek/tell no
+            # stream, que forçaria o flush) decide a rotação
+            data = (self.format(record) + self.terminator).encode(
+                self.encoding or "utf-8", self.errors or "strict")
+            if self.stream is None:
+                self.stream = self._open()
+            if 0 < self.maxBytes <= self._size + len(data):
+                self.doRollover()
+                if self.stream is None:
+                    self.stream = self._open()
+            self.stream.write(data)
+            self._size += len(data)
+            if record.levelno >= logging.WARNING:
+                self.flush()
+        except RecursionError:
+            raise
+        except Exception:
+            self.handleError(record)
+
+    def close(self) -> None:
+        self._stop.set()
+        super().close()
+
+# handlers de arquivo são por processo: create_app() repetido não os recria
+_LOGGING_CONFIGURED = False
+_ACCESS_LOGGER: logging.Logger | None = None
+
 def _setup_logging(app: Flask, app_log_file: Path) -> None:
-    if any(isinstance(h, RotatingFileHandler) for h in app.logger.handlers):
+    global _LOGGING_CONFIGURED
+    if _LOGGING_CONFIGURED:
         return
+    _LOGGING_CONFIGURED = True
     app.logger.setLevel(logging.INFO)
     handler = RotatingFileHandler(app_log_file, maxBytes=1_000_000, backupCount=3, encoding="utf-8")
     fmt = logging.Formatter(fmt="%(asctime)s %(levelname)s [%(name)s] %(message)s",
                             datefmt="%Y-%m-%d %H:%M:%S")
     handler.setFormatter(fmt)
-    app.logger.addHandler(handler)
+    app.logger.addHandler(_queued(handler))
 
 def _setup_access_logging(access_log_file: Path) -> logging.Logger:
+    global _ACCESS_LOGGER
+    if _ACCESS_LOGGER is not None:
+        return _ACCESS_LOGGER
     logger = logging.getLogger("ipelms.access")
-    if logger.handlers:
-        return logger
     logger.setLevel(logging.INFO)
-    handler = RotatingFileHandler(access_log_file, maxBytes=1_000_000, backupCount=3, encoding="utf-8")
+    handler = _BufferedRotatingFileHandler(access_log_file, maxBytes=1_000_000, backupCount=3, encoding="utf-8")
     handler.setFormatter(logging.Formatter("%(message)s"))
-    logger.addHandler(handler)
+    logger.addHandler(_queued(handler))
     logger.propagate = False
+    _ACCESS_LOGGER = logger
     return logger
 
+# headers de segurança fixos: montados uma vez, aplicados com um único update
+_CSP = sys.intern("default-src 'self'; img-src 'self' data:; style-src 'self'; "
+                  "object-src 'none'; base-uri 'self'; frame-ancestors 'none'")
+_STATIC_HEADERS = (
+    ("X-Content-Type-Options", "nosniff"),
+    ("X-Frame-Options", "DENY"),
+    ("Referrer-Policy", "strict-origin-when-cross-origin"),
+    ("Permissions-Policy", "camera=(), microphone=(), geolocation=()"),
+    ("Content-Security-Policy", _CSP),
+)
+_HSTS_HEADER = ("Strict-Transport-Security", "max-age=31536000; includeSubDomains; preload")
+
+# linha do access log (formatada só quando algum handler de fato a consome)
+_ACCESS_FMT = '%s - %s [%s] "%s %s %s" %d %s "%s" "%s" rt=%.2fms req_id=%s'
+
+# req_id = janelas de 8 bytes de um buffer aleatório de 4 KiB (um urandom a cada 512 ids)
+_RAND_BUF = bytearray(os.urandom(4096))
+_RAND_IDX = itertools.count(step=8)
+
+def _next_req_id() -> str:
+    i = next(_RAND_IDX) & 4095
+    if i == 0:
+        _RAND_BUF[:] = os.urandom(4096)
+    return _RAND_BUF[i:i + 8].hex()
+
+# data no formato do access log, reformatada no máximo uma vez por segundo
+_CLF_CACHE: tuple[int, str] = (-1, "")
+
+def _clf_now() -> str:
+    global _CLF_CACHE
+    sec = int(time.time())
+    cached_sec, cached = _CLF_CACHE
+    if cached_sec != sec:
+        cached = time.strftime("%d/%b/%Y:%H:%M:%S +0000", time.gmtime(sec))
+        _CLF_CACHE = (sec, cached)
+    return cached
+
+# uploads: o Werkzeug guarda arquivos pequenos num SpooledTemporaryFile em memória;
+# aqui todo arquivo vai direto para um temporário em disco
+class _UploadRequest(Request):
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        # arquivo temporário real (tem fileno): save_upload copia via sendfile
+        return tempfile.TemporaryFile("rb+")
+
+def _register_blueprints(app: Flask) -> None:
+    """importa os módulos de rota só ao montar o app.
+    O registro continua imediato: url_for nos templates e a CLI precisam do url_map completo.
+    """
+    from .auth import bp as auth_bp
+    from .courses import bp as courses_bp
+    from .lessons import bp as lessons_bp
+    from .notices import bp as notices_bp
+    from .assignments import bp as assignments_bp
+
+    app.register_blueprint(auth_bp)
+    app.register_blueprint(courses_bp)
+    app.register_blueprint(lessons_bp)
+    app.register_blueprint(notices_bp)
+    app.register_blueprint(assignments_bp)
+
+# raiz do projeto resolvida uma única vez (IPELMS_ROOT sobrescreve, útil em testes)
+_ROOT = Path(os.environ.get("IPELMS_ROOT") or Path(__file__).parent.parent).resolve()
+try:
+    _PATHS: dict[str, Path] | None = _setup_dirs(_ROOT)
+except OSError:
+    _PATHS = None
+
 def create_app():
-    root = Path(__file__).resolve().parent.parent
-    paths = _setup_dirs(root)
+    root = _ROOT
+    paths = _PATHS if _PATHS is not None else _setup_dirs(root)
 
     cfg = _load_json_config(paths["CONFIG_JSON"])
     secret_key = _load_secret_key(paths["SECRET_FILE"])
 
     app = Flask(__name__, instance_path=str(paths["INSTANCE_DIR"]))
+    app.request_class = _UploadRequest
     is_prod = cfg.get("environment") == "production"
 
     app.config.update(
         SECRET_KEY=secret_key,
         MAX_CONTENT_LENGTH=10 * 1024 * 1024,
         UPLOAD_FOLDER=str(paths["UPLOADS_DIR"]),
+        # mesma forma (abspath, sem seguir symlink) dos caminhos montados a partir de
+        # UPLOAD_FOLDER: uploads/ pode ser um symlink para um volume de dados
+        UPLOAD_FOLDER_ABS=os.path.abspath(paths["UPLOADS_DIR"]),
         ENVIRONMENT=cfg.get("environment", "development"),
         SITE_NAME=cfg.get("site_name", "IpêLMS"),
-        DATABASE_PATH=str((root / "data.db").resolve()),
+        ACCESS_LOG_SAMPLE=float(cfg.get("access_log_sample", 1.0)),  # 0 desliga, 1 loga tudo
+        # downloads via X-Sendfile (Apache mod_xsendfile/lighttpd); sem isso o Werkzeug
+        # já entrega o arquivo por wsgi.file_wrapper (sendfile no gunicorn)
+        USE_X_SENDFILE=bool(cfg.get("use_x_sendfile", False)),
+        # atrás do nginx: prefixo de um `location internal` que aponta para uploads/
+        # (ex.: "/protected_uploads/"); o download responde só com X-Accel-Redirect
+        X_ACCEL_REDIRECT_PREFIX=cfg.get("x_accel_redirect_prefix"),
+        # ex.: "scrypt:32768:8:1" ou "pbkdf2:sha256:200000"; None = padrão do Werkzeug
+        PWHASH_METHOD=cfg.get("password_hash_method"),
+        SQL_TRACE=bool(cfg.get("sql_trace", False)),
+        DATABASE_PATH=str(root / "data.db"),
         SESSION_COOKIE_HTTPONLY=True,
         SESSION_COOKIE_SAMESITE="Lax",
         SESSION_COOKIE_SECURE=is_prod,
     )
 
-    app.jinja_env.globals["SITE_NAME"] = app.config["SITE_NAME"]
+    app.jinja_env.globals["SITE_NAME"] = sys.intern(app.config["SITE_NAME"])
+    # bytecode dos templates em disco: um worker novo não recompila tudo
+    app.jinja_env.bytecode_cache = FileSystemBytecodeCache(str(paths["JINJA_CACHE_DIR"]))
 
     _setup_logging(app, paths["APP_LOG"])
     access_logger = _setup_access_logging(paths["ACCESS_LOG"])
@@ -112,52 +293,50 @@ def create_app():
     register_migrate_cli(app)  # <<< registra comandos de migração
 
     # Blueprints
-    app.register_blueprint(auth_bp)
-    app.register_blueprint(courses_bp)
-    app.register_blueprint(lessons_bp)
-    app.register_blueprint(notices_bp)
-    app.register_blueprint(assignments_bp)
+    _register_blueprints(app)
 
     # ---------- ciclo de request: headers + req_id + access log ----------
-    import time, secrets
-    from datetime import datetime, timezone
+    security_headers = _STATIC_HEADERS + ((_HSTS_HEADER,) if is_prod else ())
 
     @app.before_request
-    def _start_timer_and_reqid():
-        g._start_ts = time.perf_counter()
-        g.req_id = secrets.token_hex(8)
-        g.client_ip = request.headers.get("X-Forwarded-For", request.remote_addr) or "-"
+    # globais/atributos do caminho quente amarrados como defaults (lookup local)
+    def _start_timer_and_reqid(_perf=time.perf_counter, _next_id=_next_req_id):
+        g._start_ts = _perf()
+        g.req_id = _next_id()
+        environ = request.environ
+        g.client_ip = environ.get("HTTP_X_FORWARDED_FOR") or environ.get("REMOTE_ADDR") or "-"
 
     @app.after_request
-    def _security_headers_and_access_log(resp):
-        resp.headers["X-Content-Type-Options"] = "nosniff"
-        resp.headers["X-Frame-Options"] = "DENY"
-        resp.headers["Referrer-Policy"] = "strict-origin-when-cross-origin"
-        resp.headers["Permissions-Policy"] = "camera=(), microphone=(), geolocation=()"
-        resp.headers["Content-Security-Policy"] = (
-            "default-src 'self'; img-src 'self' data:; style-src 'self'; "
-            "object-src 'none'; base-uri 'self'; frame-ancestors 'none'"
-        )
-        if app.config["ENVIRONMENT"] == "production":
-            resp.headers.setdefault("Strict-Transport-Security", "max-age=31536000; includeSubDomains; preload")
+    def _security_headers_and_access_log(resp, _perf=time.perf_counter, _clf=_clf_now,
+                                         _random=random.random, _headers=security_headers,
+                                         _logger=access_logger, _fmt=_ACCESS_FMT):
+        resp.headers.update(_headers)
 
         req_id = getattr(g, "req_id", None)
         if req_id: resp.headers["X-Request-ID"] = req_id
 
+        sample = app.config["ACCESS_LOG_SAMPLE"]
+        if sample < 1.0 and (sample <= 0 or _random() >= sample):
+            return resp
+
         try:
             start_ts = getattr(g, "_start_ts", None)
-            rt_ms = (time.perf_counter() - start_ts) * 1000 if start_ts else -1
-            path_qs = f"{request.path}?{request.query_string.decode(errors='ignore')}" if request.query_string else request.path
-            proto = request.environ.get("SERVER_PROTOCOL", "HTTP/1.1")
-            length = resp.calculate_content_length() or resp.headers.get("Content-Length", "-")
+            rt_ms = (_perf() - start_ts) * 1000 if start_ts else -1
+            environ = request.environ
+            qs = environ.get("QUERY_STRING")  # já é str no WSGI
+            path_qs = f"{request.path}?{qs}" if qs else request.path
+            proto = environ.get("SERVER_PROTOCOL", "HTTP/1.1")
+            # só mede o corpo se já estiver em memória: streams logam "-" em vez de serem materializados
+            length = resp.headers.get("Content-Length")
+            if length is None:
+                length = (resp.calculate_content_length() if resp.is_sequence else None) or "-"
             user_id = g.user["id"] if getattr(g, "user", None) else "-"
-            referer = request.headers.get("Referer", "-")
-            ua = request.headers.get("User-Agent", "-")
-            ip = getattr(g, "client_ip", request.remote_addr) or "-"
-            now = datetime.now(timezone.utc).strftime("%d/%b/%Y:%H:%M:%S %z")
-            line = (f'{ip} - {user_id} [{now}] "{request.method} {path_qs} {proto}" '
-                    f'{resp.status_code} {length} "{referer}" "{ua}" rt={rt_ms:.2f}ms req_id={req_id or "-"}')
-            logging.getLogger("ipelms.access").info(line)
+            referer = environ.get("HTTP_REFERER", "-")
+            ua = environ.get("HTTP_USER_AGENT", "-")
+            ip = getattr(g, "client_ip", None) or environ.get("REMOTE_ADDR") or "-"
+            now = _clf()
+            _logger.info(_fmt, ip, user_id, now, request.method, path_qs, proto,
+                         resp.status_code, length, referer, ua, rt_ms, req_id or "-")
         except Exception as e:
             app.logger.warning("Falha ao logar acesso: %s", e)
         return resp
@@ -168,25 +347,33 @@ def create_app():
             app.logger.exception("Unhandled error req_id=%s path=%s", getattr(g, "req_id", "-"), request.path)
 
     # ----- Rotas principais -----
+    anon_index: list[bytes] = []
+
     @app.get("/")
     def index():
-        return render_template("index.html")
+        # visitante anônimo sem flashes sempre vê a mesma home: renderiza uma vez
+        if g.get("user") or "_flashes" in session:
+            return render_template("index.html")
+        if not anon_index:
+            anon_index.append(render_template("index.html").encode("utf-8"))
+        return Response(anon_index[0], mimetype="text/html")
 
     @app.get("/dashboard")
     @login_required
     def dashboard():
-        my_courses = db_module.query("""
-          SELECT c.* FROM courses c
+        rows = db_module.query("""
+          SELECT c.*, 'member' AS role FROM courses c
           JOIN course_members m ON m.course_id = c.id
           WHERE m.user_id = ?
-          ORDER BY c.created_at DESC
-        """, (g.user["id"],))
-        my_instr_courses = db_module.query("""
-          SELECT c.* FROM courses c
+          UNION ALL
+          SELECT c.*, 'instructor' AS role FROM courses c
           JOIN course_instructors i ON i.course_id = c.id
           WHERE i.user_id = ?
-          ORDER BY c.created_at DESC
-        """, (g.user["id"],))
+          ORDER BY created_at DESC
+        """, (g.user["id"], g.user["id"]))
+        my_courses, my_instr_courses = [], []
+        for r in rows:
+            (my_courses if r["role"] == "member" else my_instr_courses).append(r)
         return render_template("dashboard.html",
                                my_courses=my_courses,
                                my_instr_courses=my_instr_courses)
@@ -205,19 +392,37 @@ def create_app():
     def forbidden(err): return render_template("errors/403.html", err=err), 403
 
     @app.errorhandler(404)
-    def not_found(err): return render_template("errors/404.html", err=err), 404
+    def not_found(err): return _error_page(404, err)
 
     @app.errorhandler(400)
     def bad_request(err): return render_template("errors/400.html", err=err), 400
 
     @app.errorhandler(413)
-    def too_large(err): return render_template("errors/413.html", err=err), 413
+    def too_large(err): return _error_page(413, err)
 
     @app.errorhandler(429)
     def too_many(err): return render_template("errors/429.html", err=err), 429
 
     @app.errorhandler(500)
-    def server_error(err): return render_template("errors/500.html", err=err), 500
+    def server_error(err): return _error_page(500, err)
+
+    # login/CSRF das views marcadas pelos decorators (depois do hook que carrega g.user)
+    init_security(app)
+
+    # 404/413/500 não usam `err`: pré-renderiza a versão de visitante anônimo
+    # (caso comum: robôs e links quebrados). Logado ou com flashes pendentes,
+    # a página muda (navbar/mensagens) e segue pelo render normal.
+    with app.test_request_context("/"):
+        g.user = None
+        static_errors = {
+            code: render_template(f"errors/{code}.html", err=None).encode("utf-8")
+            for code in (404, 413, 500)
+        }
+
+    def _error_page(code: int, err):
+        if not g.get("user") and "_flashes" not in session:
+            return Response(static_errors[code], status=code, mimetype="text/html")
+        return render_template(f"errors/{code}.html", err=err), code
 
     return app
 
@@ -1,49 +1,68 @@
 from __future__ import annotations
 
+import os
+import threading
 from pathlib import Path
 from typing import Optional
 from flask import (
     Blueprint, render_template, request, redirect, url_for, flash, g,
-    current_app, send_from_directory, abort
+    current_app, abort
 )
-from werkzeug.utils import secure_filename
 
-from .db import query, execute
-from .security import login_required, csrf_protect
+from .db import query, execute, cached, transaction
+from .courses import get_course
+from .security import login_required, csrf_protect, safe_filename, save_upload, send_upload, is_under_uploads
 
 bp = Blueprint("assignments", __name__, url_prefix="/assignments")
 
-ALLOWED_EXT = {"pdf", "txt", "md", "png", "jpg", "jpeg", "gif", "zip", "pptx", "docx", "csv"}
+ALLOWED_EXT = frozenset({"pdf", "txt", "md", "png", "jpg", "jpeg", "gif", "zip", "pptx", "docx", "csv"})
 MAX_TITLE = 200
 MAX_DESC = 10_000
 MAX_TEXT = 20_000
 
 def _get_course(course_id: int) -> Optional[dict]:
-    return query("SELECT * FROM courses WHERE id = ?", (course_id,), one=True)
+    return get_course(course_id)
 
 def _get_assignment(assignment_id: int) -> Optional[dict]:
-    return query("SELECT * FROM assignments WHERE id = ?", (assignment_id,), one=True)
+    return cached(("assignment", assignment_id),
+                  lambda: query("SELECT * FROM assignments WHERE id = ?", (assignment_id,), one=True))
 
 def _is_instructor(user_id: int, course_id: int) -> bool:
-    return bool(query("SELECT 1 FROM course_instructors WHERE course_id=? AND user_id=?", (course_id, user_id), one=True))
+    return cached(("is_instructor", user_id, course_id), lambda: bool(
+        query("SELECT 1 FROM course_instructors WHERE course_id=? AND user_id=?", (course_id, user_id), one=True)))
 
 def _is_member(user_id: int, course_id: int) -> bool:
-    return bool(query("SELECT 1 FROM course_members WHERE course_id=? AND user_id=?", (course_id, user_id), one=True))
+    return cached(("is_member", user_id, course_id), lambda: bool(
+        query("SELECT 1 FROM course_members WHERE course_id=? AND user_id=?", (course_id, user_id), one=True)))
+
+def _membership(user_id: int, course_id: int) -> tuple[bool, bool]:
+    """(é instrutor, é aluno) numa única ida ao banco"""
+    return cached(("membership", user_id, course_id), lambda: _fetch_membership(user_id, course_id))
+
+def _fetch_membership(user_id: int, course_id: int) -> tuple[bool, bool]:
+    row = query("""
+        SELECT EXISTS(SELECT 1 FROM course_instructors WHERE course_id=? AND user_id=?) AS i,
+               EXISTS(SELECT 1 FROM course_members WHERE course_id=? AND user_id=?) AS m
+    """, (course_id, user_id, course_id, user_id), one=True)
+    return bool(row["i"]), bool(row["m"])
+
+# diretórios de upload já criados neste processo (evita mkdir a cada envio)
+_DIR_CACHE: set[str] = set()
+_DIR_CACHE_LOCK = threading.Lock()
 
 def _uploads_dir(course_id: int) -> Path:
     base = Path(current_app.config["UPLOAD_FOLDER"])
     p = base / "courses" / str(course_id) / "assignments"
-    p.mkdir(parents=True, exist_ok=True)
+    key = str(p)
+    if key not in _DIR_CACHE:
+        p.mkdir(parents=True, exist_ok=True)
+        with _DIR_CACHE_LOCK:
+            _DIR_CACHE.add(key)
     return p
 
 def _allowed_file(filename: str) -> bool:
-    return "." in filename and filename.rsplit(".", 1)[1].lower() in ALLOWED_EXT
-
-def _is_under_uploads(path: Path) -> bool:
-    try:
-        return Path(current_app.config["UPLOAD_FOLDER"]).resolve() in path.resolve().parents
-    except Exception:
-        return False
+    ext = os.path.splitext(filename)[1]
+    return len(ext) > 1 and ext[1:].lower() in ALLOWED_EXT
 
 @bp.get("/new/<int:course_id>")
 @login_required
@@ -99,20 +118,20 @@ def detail(assignment_id: int):
         return redirect(url_for("courses.list_courses"))
 
     user_id = g.user["id"]
-    can_view = _is_instructor(user_id, a["course_id"]) or _is_member(user_id, a["course_id"])
-    if not can_view:
+    is_instr, is_mem = _membership(user_id, a["course_id"])
+    if not (is_instr or is_mem):
         flash("Você não tem acesso a esta tarefa.", "danger")
         return redirect(url_for("courses.detail", course_id=a["course_id"]))
 
     my_submission = None
     all_submissions = None
 
-    if _is_member(user_id, a["course_id"]):
+    if is_mem:
         my_submission = query("""
             SELECT * FROM submissions WHERE assignment_id=? AND student_id=?
         """, (assignment_id, user_id), one=True)
 
-    if _is_instructor(user_id, a["course_id"]):
+    if is_instr:
         all_submissions = query("""
             SELECT s.*, u.name, u.email
             FROM submissions s
@@ -125,7 +144,7 @@ def detail(assignment_id: int):
                            assignment=a,
                            my_submission=my_submission,
                            all_submissions=all_submissions,
-                           is_instructor=_is_instructor(user_id, a["course_id"]))
+                           is_instructor=is_instr)
 
 @bp.post("/<int:assignment_id>/submit")
 @login_required
@@ -148,36 +167,38 @@ def submit(assignment_id: int):
     file = request.files.get("attachment")
     rel_path = None
     if file and file.filename:
-        filename = secure_filename(file.filename)
+        filename = safe_filename(file.filename)
         if not _allowed_file(filename):
             flash("Extensão de arquivo não permitida.", "danger")
             return redirect(url_for("assignments.detail", assignment_id=assignment_id))
         dest_dir = _uploads_dir(a["course_id"])
         final_name = f"assign_{assignment_id}__u_{user_id}__{filename}"
         dest_path = dest_dir / final_name
-        file.save(dest_path)
+        save_upload(file, dest_path)
         rel_path = dest_path.relative_to(Path(current_app.config["UPLOAD_FOLDER"]))
 
-    existing = query("SELECT id, attachment_path FROM submissions WHERE assignment_id=? AND student_id=?",
+    new_path = str(rel_path) if rel_path else None
+    # upsert: dois envios simultâneos não batem no índice único; o anexo anterior
+    # é lido na mesma transação (IMMEDIATE) que o substitui
+    with transaction(immediate=True):
+        prev = query("SELECT attachment_path FROM submissions WHERE assignment_id=? AND student_id=?",
                      (assignment_id, user_id), one=True)
-    if existing:
-        if rel_path and existing["attachment_path"]:
-            old = Path(current_app.config["UPLOAD_FOLDER"]) / existing["attachment_path"]
-            if old.exists() and _is_under_uploads(old):
-                try: old.unlink()
-                except Exception: current_app.logger.warning("Falha ao apagar anexo antigo: %s", old)
-        execute("""
-            UPDATE submissions
-               SET text=?, attachment_path=COALESCE(?, attachment_path), submitted_at=CURRENT_TIMESTAMP
-             WHERE id=?
-        """, (text or None, str(rel_path) if rel_path else None, existing["id"]))
-        flash("Envio atualizado.", "success")
-    else:
         execute("""
             INSERT INTO submissions(assignment_id, student_id, text, attachment_path)
             VALUES (?,?,?,?)
-        """, (assignment_id, user_id, text or None, str(rel_path) if rel_path else None))
-        flash("Envio realizado.", "success")
+            ON CONFLICT(assignment_id, student_id) DO UPDATE
+               SET text=excluded.text,
+                   attachment_path=COALESCE(excluded.attachment_path, submissions.attachment_path),
+                   submitted_at=CURRENT_TIMESTAMP
+        """, (assignment_id, user_id, text or None, new_path))
+
+    old_path = prev["attachment_path"] if prev else None
+    if new_path and old_path and old_path != new_path:
+        old = Path(current_app.config["UPLOAD_FOLDER"]) / old_path
+        if old.exists() and is_under_uploads(old):
+            try: old.unlink()
+            except Exception: current_app.logger.warning("Falha ao apagar anexo antigo: %s", old)
+    flash("Envio atualizado." if prev else "Envio realizado.", "success")
 
     return redirect(url_for("assignments.detail", assignment_id=assignment_id))
 
@@ -195,9 +216,9 @@ def download(submission_id: int):
     if not (_is_instructor(user_id, s["course_id"]) or user_id == s["student_id"]):
         abort(403)
     abs_path = Path(current_app.config["UPLOAD_FOLDER"]) / s["attachment_path"]
-    if not abs_path.exists() or not _is_under_uploads(abs_path):
+    if not abs_path.exists() or not is_under_uploads(abs_path):
         abort(404)
-    return send_from_directory(abs_path.parent, abs_path.name, as_attachment=True)
+    return send_upload(abs_path, s["attachment_path"])
 
 @bp.post("/<int:assignment_id>/grade/<int:student_id>")
 @login_required
@@ -241,18 +262,18 @@ def grade(assignment_id: int, student_id: int):
 @bp.get("/grades/<int:course_id>")
 @login_required
 def my_grades(course_id: int):
-    if not (_is_member(g.user["id"], course_id) or _is_instructor(g.user["id"], course_id)):
+    if not any(_membership(g.user["id"], course_id)):
         flash("Você não tem acesso a este boletim.", "danger")
         return redirect(url_for("courses.detail", course_id=course_id))
     rows = query("""
         SELECT a.id AS assignment_id, a.title,
-               s.grade, s.feedback, s.submitted_at, s.graded_at
+               s.grade, s.feedback, s.submitted_at, s.graded_at,
+               AVG(s.grade) OVER () AS avg_grade
         FROM assignments a
         LEFT JOIN submissions s
                ON s.assignment_id = a.id AND s.student_id = ?
         WHERE a.course_id = ?
         ORDER BY a.created_at
     """, (g.user["id"], course_id))
-    grades = [r["grade"] for r in rows if r["grade"] is not None]
-    avg = sum(grades)/len(grades) if grades else None
+    avg = rows[0]["avg_grade"] if rows else None  # AVG ignora notas NULL
     return render_template("assignments/grades.html", course_id=course_id, rows=rows, avg=avg)
\ No newline at end of file
@@ -1,15 +1,41 @@
 from __future__ import annotations
 
 import re
+import secrets
 from flask import Blueprint, render_template, request, redirect, url_for, flash, session, g, current_app
 from werkzeug.security import generate_password_hash, check_password_hash
 
-from .db import query, execute
+from .db import query, execute, TTLCache
 from .security import csrf_protect, get_csrf_token, rate_limit
 
 bp = Blueprint("auth", __name__, url_prefix="/auth")
 
-EMAIL_RE = re.compile(r"^[^@]+@[^@]+\.[^@]+$")
+EMAIL_RE = re.compile(r"[^@]+@[^@]+\.[^@]+", re.ASCII)
+
+# Cache curto (por processo) do usuário da sessão: evita um SELECT em todo request.
+# Não há rota que altere users; ao criar uma, chame _USER_CACHE.pop(user_id).
+_USER_CACHE = TTLCache(ttl=30.0, maxsize=2048)
+
+def _load_user(user_id: int):
+    # não guarda ausência: um id recém-criado não pode ficar 30 s "inexistente"
+    return _USER_CACHE.get_or_load(user_id, lambda: query(
+        "SELECT id, name, email, role FROM users WHERE id = ?", (user_id,), one=True), cache_none=False)
+
+def _hash_password(password: str) -> str:
+    method = current_app.config.get("PWHASH_METHOD")
+    if method:
+        return generate_password_hash(password, method=method, salt_length=16)
+    return generate_password_hash(password)
+
+# Hash descartável (mesmo método dos reais) conferido quando o e-mail não existe:
+# o login custa o mesmo com ou sem conta, sem vazar quais e-mails estão cadastrados.
+_DUMMY_HASH: str | None = None
+
+def _dummy_hash() -> str:
+    global _DUMMY_HASH
+    if _DUMMY_HASH is None:
+        _DUMMY_HASH = _hash_password(secrets.token_urlsafe(12))
+    return _DUMMY_HASH
 
 # Carrega o usuário logado (se houver) em g.user a cada request
 @bp.before_app_request
@@ -18,7 +44,7 @@ def load_logged_in_user():
     if user_id is None:
         g.user = None
     else:
-        g.user = query("SELECT id, name, email, role FROM users WHERE id = ?", (user_id,), one=True)
+        g.user = _load_user(user_id)
 
 # Deixa 'current_user' e 'csrf_token' disponíveis nos templates
 @bp.app_context_processor
@@ -42,7 +68,7 @@ def register_post():
     # Validações básicas
     if len(name) < 2:
         flash("Nome muito curto.", "danger"); return redirect(url_for("auth.register_form"))
-    if not EMAIL_RE.match(email):
+    if not EMAIL_RE.fullmatch(email):
         flash("E-mail inválido.", "danger"); return redirect(url_for("auth.register_form"))
     if len(password) < 6:
         flash("Senha deve ter pelo menos 6 caracteres.", "danger"); return redirect(url_for("auth.register_form"))
@@ -54,7 +80,7 @@ def register_post():
         flash("E-mail já cadastrado.", "danger")
         return redirect(url_for("auth.register_form"))
 
-    pwd_hash = generate_password_hash(password)
+    pwd_hash = _hash_password(password)
     user_id = execute(
         "INSERT INTO users(name, email, password_hash, role) VALUES (?, ?, ?, 'student')",
         (name, email, pwd_hash)
@@ -76,6 +102,8 @@ def login_post():
     email = (request.form.get("email") or "").strip().lower()
     password = request.form.get("password") or ""
     user = query("SELECT id, name, email, password_hash, role FROM users WHERE email = ?", (email,), one=True)
+    if not user:
+        check_password_hash(_dummy_hash(), password)
     if not user or not check_password_hash(user["password_hash"], password):
         flash("Credenciais inválidas.", "danger")
         return redirect(url_for("auth.login"))
@@ -6,23 +6,27 @@ from flask import (
     Blueprint, render_template, request, redirect, url_for,
     flash, g, current_app
 )
-from .db import query, execute
+from .db import query, execute, transaction, TTLCache
 from .security import login_required, csrf_protect
 
 bp = Blueprint("courses", __name__, url_prefix="/courses")
 
-CODE_RE = re.compile(r"^[A-Z0-9-]{3,10}$")
+CODE_RE = re.compile(r"[A-Z0-9-]{3,10}", re.ASCII)
 
-def _get_course(course_id: int) -> Optional[dict]:
-    return query("SELECT * FROM courses WHERE id = ?", (course_id,), one=True)
+# Cache (por processo) das linhas de courses, usado também por lessons/notices/assignments.
+# Não há rota que edite ou apague cursos; ao criar uma, chame forget_course(course_id).
+_COURSE_CACHE = TTLCache(ttl=300.0, maxsize=1024)
+
+def get_course(course_id: int) -> Optional[dict]:
+    # não guarda ausência: o id pode ser criado logo depois
+    return _COURSE_CACHE.get_or_load(course_id, lambda: query(
+        "SELECT * FROM courses WHERE id = ?", (course_id,), one=True), cache_none=False)
 
-def _is_instructor(user_id: int, course_id: int) -> bool:
-    row = query("SELECT 1 FROM course_instructors WHERE course_id=? AND user_id=?", (course_id, user_id), one=True)
-    return bool(row)
+def forget_course(course_id: int) -> None:
+    _COURSE_CACHE.pop(course_id)
 
-def _is_member(user_id: int, course_id: int) -> bool:
-    row = query("SELECT 1 FROM course_members WHERE course_id=? AND user_id=?", (course_id, user_id), one=True)
-    return bool(row)
+def _get_course(course_id: int) -> Optional[dict]:
+    return get_course(course_id)
 
 @bp.get("/")
 def list_courses():
@@ -49,75 +53,68 @@ def create_course():
 
     if len(title) < 3:
         flash("Título muito curto.", "danger"); return redirect(url_for("courses.new_course"))
-    if not CODE_RE.match(code):
+    if not CODE_RE.fullmatch(code):
         flash("Código inválido (use A-Z, 0-9, '-' e 3–10 chars).", "danger"); return redirect(url_for("courses.new_course"))
 
     if query("SELECT id FROM courses WHERE code = ?", (code,), one=True):
         flash("Já existe um curso com esse código.", "danger"); return redirect(url_for("courses.new_course"))
 
-    course_id = execute(
-        "INSERT INTO courses(title, description, code, created_by) VALUES (?, ?, ?, ?)",
-        (title, description, code, g.user["id"])
-    )
-    execute("INSERT OR IGNORE INTO course_instructors(course_id, user_id) VALUES (?, ?)", (course_id, g.user["id"]))
+    with transaction():  # curso + instrutor num único commit
+        course_id = execute(
+            "INSERT INTO courses(title, description, code, created_by) VALUES (?, ?, ?, ?)",
+            (title, description, code, g.user["id"])
+        )
+        execute("INSERT OR IGNORE INTO course_instructors(course_id, user_id) VALUES (?, ?)", (course_id, g.user["id"]))
     current_app.logger.info("Curso criado: id=%s code=%s by user_id=%s", course_id, code, g.user["id"])
     flash("Curso criado com sucesso!", "success")
     return redirect(url_for("courses.detail", course_id=course_id))
 
 @bp.get("/<int:course_id>")
 def detail(course_id: int):
-    course = _get_course(course_id)
+    # 1ª ida: curso + nº de alunos + papéis do usuário (anônimo => user_id NULL => falso)
+    user_id = g.user["id"] if g.get("user") else None
+    course = query("""
+        SELECT c.*,
+               (SELECT COUNT(*) FROM course_members WHERE course_id = c.id) AS members_count,
+               EXISTS(SELECT 1 FROM course_instructors WHERE course_id = c.id AND user_id = ?) AS is_instr,
+               EXISTS(SELECT 1 FROM course_members WHERE course_id = c.id AND user_id = ?) AS is_mem
+        FROM courses c
+        WHERE c.id = ?
+    """, (user_id, user_id, course_id), one=True)
     if not course:
         flash("Curso não encontrado.", "danger")
         return redirect(url_for("courses.list_courses"))
 
-    instructors = query("""
-        SELECT u.id, u.name, u.email
-        FROM course_instructors ci
-        JOIN users u ON u.id = ci.user_id
-        WHERE ci.course_id = ?
-        ORDER BY u.name
-    """, (course_id,))
-
-    members_count = query("SELECT COUNT(*) AS c FROM course_members WHERE course_id = ?", (course_id,), one=True)["c"]
-
-    lessons = query("""
-        SELECT id, title, created_at, attachment_path
-        FROM lessons
-        WHERE course_id = ?
-        ORDER BY created_at DESC
-    """, (course_id,))
-
-    notices = query("""
-        SELECT id, title, created_at
-        FROM notices
-        WHERE course_id = ?
-        ORDER BY created_at DESC
-    """, (course_id,))
-
-    assignments = query("""
-        SELECT id, title, created_at
-        FROM assignments
-        WHERE course_id = ?
-        ORDER BY created_at DESC
-    """, (course_id,))
-
-    is_instr = False
-    is_mem = False
-    if g.get("user"):
-        is_instr = _is_instructor(g.user["id"], course_id)
-        is_mem = _is_member(g.user["id"], course_id)
+    # 2ª ida: aulas, avisos, tarefas e instrutores num UNION ALL, separados por `kind`
+    rows = query("""
+        SELECT 'lesson' AS kind, id, title, NULL AS name, NULL AS email, created_at, attachment_path
+          FROM lessons WHERE course_id = ?
+        UNION ALL
+        SELECT 'notice', id, title, NULL, NULL, created_at, NULL
+          FROM notices WHERE course_id = ?
+        UNION ALL
+        SELECT 'assignment', id, title, NULL, NULL, created_at, NULL
+          FROM assignments WHERE course_id = ?
+        UNION ALL
+        SELECT 'instructor', u.id, NULL, u.name, u.email, NULL, NULL
+          FROM course_instructors ci JOIN users u ON u.id = ci.user_id
+         WHERE ci.course_id = ?
+        ORDER BY kind, created_at DESC, name
+    """, (course_id,) * 4)
+    by_kind: dict[str, list] = {"lesson": [], "notice": [], "assignment": [], "instructor": []}
+    for r in rows:
+        by_kind[r["kind"]].append(r)
 
     return render_template(
         "courses/detail.html",
         course=course,
-        instructors=instructors,
-        members_count=members_count,
-        lessons=lessons,
-        notices=notices,
-        assignments=assignments,
-        is_instr=is_instr,
-        is_mem=is_mem
+        instructors=by_kind["instructor"],
+        members_count=course["members_count"],
+        lessons=by_kind["lesson"],
+        notices=by_kind["notice"],
+        assignments=by_kind["assignment"],
+        is_instr=bool(course["is_instr"]),
+        is_mem=bool(course["is_mem"])
     )
 
 @bp.post("/<int:course_id>/join")
@@ -1,53 +1,154 @@
 from __future__ import annotations
 
 import sqlite3
+import threading
+import time
+from contextlib import contextmanager
 from pathlib import Path
-from typing import Iterable, Optional, Any
+from typing import Any, Callable, Iterable, Iterator, Optional, TypeVar
 from flask import current_app, g
 
 DB_FILENAME = "data.db"
 
-def _db_path() -> Path:
+T = TypeVar("T")
+
+def _db_path() -> str:
     """retorna o caminho absluto para o arquvi do banco"""
-    # current_app.root_path -> .../ipelms
-    project_root = Path(current_app.root_path).parent
-    return project_root / DB_FILENAME
+    # create_app já resolve DATABASE_PATH (o mesmo usado pela CLI de migração);
+    # sem ele, calcula uma vez e guarda na config
+    path = current_app.config.get("DATABASE_PATH")
+    if not path:
+        # current_app.root_path -> .../ipelms
+        path = str(Path(current_app.root_path).parent / DB_FILENAME)
+        current_app.config["DATABASE_PATH"] = path
+    return path
+
+# uma conexão por thread (worker), reaproveitada entre requests: mantém o cache
+# de statements compilados (cached_statements) e os PRAGMAs já aplicados
+_local = threading.local()
+
+def _connect(db_path: str) -> sqlite3.Connection:
+    conn = sqlite3.connect(
+        db_path,
+        detect_types=sqlite3.PARSE_DECLTYPES,
+        check_same_thread=False, #enable cli do flask
+        cached_statements=256,
+    )
+    conn.row_factory = sqlite3.Row
+    # garantir integridade
+    conn.execute("PRAGMA foreign_keys = ON;")
+    # WAL: leitores não bloqueiam o escritor; NORMAL dispensa fsync por commit
+    conn.execute("PRAGMA journal_mode = WAL;")
+    conn.execute("PRAGMA synchronous = NORMAL;")
+    conn.execute("PRAGMA temp_store = MEMORY;")
+    conn.execute("PRAGMA cache_size = -20000;")  # ~20 MB
+    conn.execute("PRAGMA mmap_size = 268435456;")  # 256 MB
+    conn.execute("PRAGMA busy_timeout = 5000;")
+    if current_app.config.get("SQL_TRACE"):
+        # loga cada statement executado (útil para achar N+1)
+        logger = current_app.logger
+        conn.set_trace_callback(lambda sql: logger.info("SQL: %s", sql))
+    return conn
 
 def get_db() -> sqlite3.Connection:
-    """obtem a conexao por request"""
+    """obtem a conexao da thread atual (guardada em g durante o request)"""
     if "db" not in g:
         db_path = _db_path()
-        conn = sqlite3.connect(
-            db_path,
-            detect_types=sqlite3.PARSE_DECLTYPES,
-            check_same_thread=False, #enable cli do flask
-        )
-        conn.row_factory = sqlite3.Row
-        # garantir integridade
-        conn.execute("PRAGMA foreign_keys = ON;")
+        conns = getattr(_local, "conns", None)
+        if conns is None:
+            conns = _local.conns = {}
+        conn = conns.get(db_path)
+        if conn is None:
+            conn = conns[db_path] = _connect(db_path)
         g.db = conn
     return g.db
 
 def close_db(e: Optional[BaseException] = None) -> None:
-    """fecha a conexao"""
+    """devolve a conexao: não fecha, só descarta transação pendente"""
     db = g.pop("db", None)
-    if db is not None:
-        db.close()
+    if db is not None and db.in_transaction:
+        db.rollback()
 
 def query(sql: str, params: Iterable[Any] = (), one: bool = False):
-    cur = get_db().execute(sql, tuple(params))
-    rows = cur.fetchall()
-    cur.close()
-    return (rows[0] if rows else None) if one else rows
+    cur = get_db().execute(sql, params if isinstance(params, tuple) else tuple(params))
+    try:
+        return cur.fetchone() if one else cur.fetchall()
+    finally:
+        cur.close()
+
+def cached(key: tuple, fn: Callable[[], T]) -> T:
+    """memoiza `fn()` em g durante o request (zerado a cada escrita via execute)"""
+    cache = g.setdefault("_query_cache", {})
+    if key not in cache:
+        cache[key] = fn()
+    return cache[key]
+
+class TTLCache:
+    """cache pequeno por processo (entre requests): cada chave vale `ttl` segundos.
+    Cheio, descarta os expirados e, se não bastar, a chave mais antiga."""
+
+    def __init__(self, ttl: float, maxsize: int) -> None:
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self._data: dict[Any, tuple[float, Any]] = {}
+        self._lock = threading.Lock()
+
+    def get_or_load(self, key: Any, load: Callable[[], T], cache_none: bool = True) -> T:
+        now = time.monotonic()
+        with self._lock:
+            hit = self._data.get(key)
+            if hit and hit[0] > now:
+                return hit[1]
+        value = load()
+        if value is None and not cache_none:
+            return value
+        with self._lock:
+            data = self._data
+            if len(data) >= self.maxsize:
+                for k in [k for k, (exp, _) in data.items() if exp <= now]:
+                    del data[k]
+                if len(data) >= self.maxsize:
+                    data.pop(next(iter(data)))
+            data[key] = (now + self.ttl, value)
+        return value
+
+    def pop(self, key: Any) -> None:
+        with self._lock:
+            self._data.pop(key, None)
 
 def execute(sql: str, params: Iterable[Any] = ()) -> int:
-    cur = get_db().execute(sql, tuple(params))
-    get_db().commit()
+    g.pop("_query_cache", None)
+    conn = get_db()
+    params = params if isinstance(params, tuple) else tuple(params)
+    if g.get("_in_transaction"):
+        cur = conn.execute(sql, params)  # commit fica com transaction()
+    else:
+        with conn:  # commit (ou rollback em erro) feito pelo próprio sqlite3
+            cur = conn.execute(sql, params)
     last_id = cur.lastrowid
     cur.close()
     return last_id
 
+@contextmanager
+def transaction(immediate: bool = False) -> Iterator[sqlite3.Connection]:
+    """agrupa vários execute() num único commit (rollback se algo falhar).
+    immediate: pega a trava de escrita já no BEGIN, para que o que for lido no
+    bloco não mude até o commit (leitura-e-escrita sem corrida)"""
+    conn = get_db()
+    if g.get("_in_transaction"):  # aninhada: quem abriu primeiro faz o commit
+        yield conn
+        return
+    g._in_transaction = True
+    try:
+        with conn:
+            if immediate:
+                conn.execute("BEGIN IMMEDIATE")
+            yield conn
+    finally:
+        g._in_transaction = False
+
 def executescript(script: str) -> None:
+    g.pop("_query_cache", None)
     get_db().executescript(script)
     get_db().commit()
 
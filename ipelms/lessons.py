@@ -1,36 +1,43 @@
 from __future__ import annotations
 
 import os
+import secrets
 from pathlib import Path
 from typing import Optional
 from flask import (
     Blueprint, render_template, request, redirect, url_for, flash, g,
-    current_app, send_from_directory, abort
+    current_app, abort
 )
-from werkzeug.utils import secure_filename
 
-from .db import query, execute
-from .security import login_required, csrf_protect
+from .db import query, execute, cached
+from .courses import get_course
+from .security import login_required, csrf_protect, safe_filename, save_upload, send_upload, is_under_uploads
 
 bp = Blueprint("lessons", __name__, url_prefix="/lessons")
 
-ALLOWED_EXT = {"pdf", "txt", "md", "png", "jpg", "jpeg", "gif", "zip", "pptx", "docx", "csv"}
+ALLOWED_EXT = frozenset({"pdf", "txt", "md", "png", "jpg", "jpeg", "gif", "zip", "pptx", "docx", "csv"})
 MAX_TITLE = 200
 MAX_CONTENT = 20_000  # 20k chars
 
 def _get_course(course_id: int) -> Optional[dict]:
-    return query("SELECT * FROM courses WHERE id = ?", (course_id,), one=True)
-
-def _get_lesson(lesson_id: int) -> Optional[dict]:
-    return query("SELECT * FROM lessons WHERE id = ?", (lesson_id,), one=True)
+    return get_course(course_id)
+
+def _get_lesson_with_perm(lesson_id: int, user_id: int) -> Optional[dict]:
+    """aula + título/código do curso + papéis do usuário numa única consulta"""
+    return query("""
+        SELECT l.*, c.title AS course_title, c.code AS course_code,
+               EXISTS(SELECT 1 FROM course_instructors ci
+                       WHERE ci.course_id = l.course_id AND ci.user_id = ?) AS is_instr,
+               EXISTS(SELECT 1 FROM course_members cm
+                       WHERE cm.course_id = l.course_id AND cm.user_id = ?) AS is_member
+        FROM lessons l
+        JOIN courses c ON c.id = l.course_id
+        WHERE l.id = ?
+    """, (user_id, user_id, lesson_id), one=True)
 
 def _is_instructor(user_id: int, course_id: int) -> bool:
-    row = query("SELECT 1 FROM course_instructors WHERE course_id=? AND user_id=?", (course_id, user_id), one=True)
-    return bool(row)
-
-def _is_member(user_id: int, course_id: int) -> bool:
-    row = query("SELECT 1 FROM course_members WHERE course_id=? AND user_id=?", (course_id, user_id), one=True)
-    return bool(row)
+    return cached(("is_instructor", user_id, course_id), lambda: bool(
+        query("SELECT 1 FROM course_instructors WHERE course_id=? AND user_id=?", (course_id, user_id), one=True)))
 
 def _require_instructor(course_id: int) -> Optional[dict]:
     if not g.get("user"):
@@ -45,11 +52,6 @@ def _require_instructor(course_id: int) -> Optional[dict]:
         return None
     return course
 
-def _require_can_view(course_id: int) -> bool:
-    if not g.get("user"):
-        return False
-    return _is_instructor(g.user["id"], course_id) or _is_member(g.user["id"], course_id)
-
 def _course_lessons_dir(course_id: int) -> Path:
     base = Path(current_app.config["UPLOAD_FOLDER"])
     p = base / "courses" / str(course_id) / "lessons"
@@ -57,13 +59,8 @@ def _course_lessons_dir(course_id: int) -> Path:
     return p
 
 def _allowed_file(filename: str) -> bool:
-    return "." in filename and filename.rsplit(".", 1)[1].lower() in ALLOWED_EXT
-
-def _is_under_uploads(path: Path) -> bool:
-    try:
-        return Path(current_app.config["UPLOAD_FOLDER"]).resolve() in path.resolve().parents
-    except Exception:
-        return False
+    ext = os.path.splitext(filename)[1]
+    return len(ext) > 1 and ext[1:].lower() in ALLOWED_EXT
 
 @bp.get("/new/<int:course_id>")
 @login_required
@@ -91,23 +88,34 @@ def create(course_id: int):
         flash("Conteúdo muito longo.", "danger")
         return redirect(url_for("lessons.new", course_id=course_id))
 
-    lesson_id = execute(
-        "INSERT INTO lessons(course_id, title, content, created_by) VALUES (?,?,?,?)",
-        (course_id, title, content, g.user["id"])
-    )
-
     file = request.files.get("attachment")
+    dest_path = rel_path = None
     if file and file.filename:
-        filename = secure_filename(file.filename)
+        filename = safe_filename(file.filename)
         if not _allowed_file(filename):
             flash("Extensão de arquivo não permitida.", "danger")
             return redirect(url_for("lessons.new", course_id=course_id))
-        dest_dir = _course_lessons_dir(course_id)
-        final_name = f"lesson_{lesson_id}__{filename}"
-        dest_path = dest_dir / final_name
-        file.save(dest_path)
-        rel_path = dest_path.relative_to(Path(current_app.config["UPLOAD_FOLDER"]))
-        execute("UPDATE lessons SET attachment_path=? WHERE id=?", (str(rel_path), lesson_id))
+        # nome não depende do id da aula: o caminho já entra no INSERT (uma escrita só)
+        dest_path = _course_lessons_dir(course_id) / f"lesson_{secrets.token_hex(8)}__{filename}"
+        rel_path = str(dest_path.relative_to(Path(current_app.config["UPLOAD_FOLDER"])))
+
+    lesson_id = execute(
+        "INSERT INTO lessons(course_id, title, content, created_by, attachment_path) VALUES (?,?,?,?,?)",
+        (course_id, title, content, g.user["id"], rel_path)
+    )
+
+    if dest_path is not None:
+        try:
+            save_upload(file, dest_path, drop_cache=True)
+        except OSError:
+            current_app.logger.exception("Falha ao salvar anexo: lesson=%s file=%s", lesson_id, dest_path)
+            execute("DELETE FROM lessons WHERE id=?", (lesson_id,))
+            try:
+                dest_path.unlink()
+            except OSError:
+                pass
+            flash("Falha ao salvar o anexo; a aula não foi criada.", "danger")
+            return redirect(url_for("lessons.new", course_id=course_id))
         current_app.logger.info("Upload anexo: lesson=%s file=%s", lesson_id, dest_path)
 
     flash("Aula criada com sucesso!", "success")
@@ -116,38 +124,37 @@ def create(course_id: int):
 @bp.get("/<int:lesson_id>")
 @login_required
 def detail(lesson_id: int):
-    lesson = _get_lesson(lesson_id)
+    lesson = _get_lesson_with_perm(lesson_id, g.user["id"])
     if not lesson:
         flash("Aula não encontrada.", "danger")
         return redirect(url_for("courses.list_courses"))
-    if not _require_can_view(lesson["course_id"]):
+    if not (lesson["is_instr"] or lesson["is_member"]):
         flash("Você não tem acesso a esta aula.", "danger")
         return redirect(url_for("courses.detail", course_id=lesson["course_id"]))
-    is_instr = _is_instructor(g.user["id"], lesson["course_id"])
-    return render_template("lessons/detail.html", lesson=lesson, is_instr=is_instr)
+    return render_template("lessons/detail.html", lesson=lesson, is_instr=bool(lesson["is_instr"]))
 
 @bp.get("/<int:lesson_id>/edit")
 @login_required
 def edit(lesson_id: int):
-    lesson = _get_lesson(lesson_id)
+    lesson = _get_lesson_with_perm(lesson_id, g.user["id"])
     if not lesson:
         flash("Aula não encontrada.", "danger")
         return redirect(url_for("courses.list_courses"))
-    course = _require_instructor(lesson["course_id"])
-    if not course:
+    if not lesson["is_instr"]:
+        flash("Apenas instrutores podem realizar esta ação.", "danger")
         return redirect(url_for("courses.detail", course_id=lesson["course_id"]))
-    return render_template("lessons/edit.html", lesson=lesson, course=course)
+    return render_template("lessons/edit.html", lesson=lesson)
 
 @bp.post("/<int:lesson_id>/edit")
 @login_required
 @csrf_protect
 def edit_post(lesson_id: int):
-    lesson = _get_lesson(lesson_id)
+    lesson = _get_lesson_with_perm(lesson_id, g.user["id"])
     if not lesson:
         flash("Aula não encontrada.", "danger")
         return redirect(url_for("courses.list_courses"))
-    course = _require_instructor(lesson["course_id"])
-    if not course:
+    if not lesson["is_instr"]:
+        flash("Apenas instrutores podem realizar esta ação.", "danger")
         return redirect(url_for("courses.detail", course_id=lesson["course_id"]))
 
     title = (request.form.get("title") or "").strip()
@@ -163,20 +170,20 @@ def edit_post(lesson_id: int):
 
     file = request.files.get("attachment")
     if file and file.filename:
-        filename = secure_filename(file.filename)
+        filename = safe_filename(file.filename)
         if not _allowed_file(filename):
             flash("Extensão de arquivo não permitida.", "danger")
             return redirect(url_for("lessons.edit", lesson_id=lesson_id))
         dest_dir = _course_lessons_dir(lesson["course_id"])
         final_name = f"lesson_{lesson_id}__{filename}"
         dest_path = dest_dir / final_name
-        file.save(dest_path)
+        save_upload(file, dest_path, drop_cache=True)
         rel_path = dest_path.relative_to(Path(current_app.config["UPLOAD_FOLDER"]))
 
         old = lesson["attachment_path"]
         if old:
             old_abs = Path(current_app.config["UPLOAD_FOLDER"]) / old
-            if old_abs.exists() and _is_under_uploads(old_abs):
+            if old_abs.exists() and is_under_uploads(old_abs):
                 try:
                     old_abs.unlink()
                 except Exception:
@@ -192,17 +199,17 @@ def edit_post(lesson_id: int):
 @login_required
 @csrf_protect
 def delete(lesson_id: int):
-    lesson = _get_lesson(lesson_id)
+    lesson = _get_lesson_with_perm(lesson_id, g.user["id"])
     if not lesson:
         flash("Aula não encontrada.", "danger")
         return redirect(url_for("courses.list_courses"))
-    course = _require_instructor(lesson["course_id"])
-    if not course:
+    if not lesson["is_instr"]:
+        flash("Apenas instrutores podem realizar esta ação.", "danger")
         return redirect(url_for("courses.detail", course_id=lesson["course_id"]))
 
     if lesson["attachment_path"]:
         abs_path = Path(current_app.config["UPLOAD_FOLDER"]) / lesson["attachment_path"]
-        if abs_path.exists() and _is_under_uploads(abs_path):
+        if abs_path.exists() and is_under_uploads(abs_path):
             try:
                 abs_path.unlink()
             except Exception:
@@ -215,18 +222,16 @@ def delete(lesson_id: int):
 @bp.get("/download/<int:lesson_id>")
 @login_required
 def download(lesson_id: int):
-    lesson = _get_lesson(lesson_id)
+    lesson = _get_lesson_with_perm(lesson_id, g.user["id"])
     if not lesson:
         abort(404)
-    if not _require_can_view(lesson["course_id"]):
+    if not (lesson["is_instr"] or lesson["is_member"]):
         abort(403)
     if not lesson["attachment_path"]:
         abort(404)
     abs_path = Path(current_app.config["UPLOAD_FOLDER"]) / lesson["attachment_path"]
     if not abs_path.exists():
         abort(404)
-    if not _is_under_uploads(abs_path):
+    if not is_under_uploads(abs_path):
         abort(403)
-    directory = abs_path.parent
-    filename = abs_path.name
-    return send_from_directory(directory, filename, as_attachment=True)
\ No newline at end of file
+    return send_upload(abs_path, lesson["attachment_path"])
\ No newline at end of file
@@ -1,9 +1,14 @@
 from __future__ import annotations
 
 import click
+import os
+import re
 import sqlite3
+from contextlib import contextmanager
+from functools import lru_cache
+from operator import itemgetter
 from pathlib import Path
-from typing import List, Tuple
+from typing import Iterator, List, Tuple
 from flask import current_app
 
 def _db_path() -> Path:
@@ -13,6 +18,23 @@ def _migrations_dir() -> Path:
     # raiz do projeto = ipelms/../
     return Path(__file__).resolve().parent.parent / "migrations"
 
+@contextmanager
+def _connect() -> Iterator[sqlite3.Connection]:
+    """conexão do comando, com os PRAGMAs do app; commit e close ao sair
+    (o `with sqlite3.connect()` sozinho só faz commit, não fecha)"""
+    conn = sqlite3.connect(_db_path())
+    try:
+        conn.row_factory = sqlite3.Row
+        # app no ar: espera o lock de escrita dos workers em vez de falhar na hora
+        conn.execute("PRAGMA busy_timeout = 5000")
+        conn.execute("PRAGMA journal_mode = WAL")
+        conn.execute("PRAGMA synchronous = NORMAL")
+        conn.execute("PRAGMA foreign_keys = ON")
+        with conn:
+            yield conn
+    finally:
+        conn.close()
+
 def _ensure_table(conn: sqlite3.Connection):
     conn.execute("""
         CREATE TABLE IF NOT EXISTS schema_migrations(
@@ -22,14 +44,24 @@ def _ensure_table(conn: sqlite3.Connection):
         )
     """)
 
-def _list_migration_files() -> List[Tuple[str, str, Path]]:
+_MIGRATION_RE = re.compile(r"(\d{4})_(.+)\.sql", re.ASCII)
+
+def _list_migration_files() -> Tuple[Tuple[str, str, Path], ...]:
     """Retorna [(version, name, path)] ordenado lexicograficamente."""
-    items: List[Tuple[str, str, Path]] = []
-    for p in sorted(_migrations_dir().glob("[0-9][0-9][0-9][0-9]_*.sql")):
-        stem = p.stem  # ex: 0001_initial
-        version, name = stem.split("_", 1)
-        items.append((version, name, p))
-    return items
+    # mtime do diretório muda quando um .sql é criado/removido/renomeado
+    d = _migrations_dir()
+    return _scan_migrations(str(d), d.stat().st_mtime_ns)
+
+@lru_cache(maxsize=1)
+def _scan_migrations(directory: str, mtime_ns: int) -> Tuple[Tuple[str, str, Path], ...]:
+    items: List[Tuple[str, str, str]] = []
+    with os.scandir(directory) as it:
+        for entry in it:
+            m = _MIGRATION_RE.fullmatch(entry.name)  # ex: 0001_initial.sql
+            if m:
+                items.append((entry.name, m[2], entry.path))
+    items.sort(key=itemgetter(0))
+    return tuple((fname[:4], name, Path(path)) for fname, name, path in items)
 
 def _applied_versions(conn: sqlite3.Connection) -> set[str]:
     rows = conn.execute("SELECT version FROM schema_migrations ORDER BY version").fetchall()
@@ -41,8 +73,7 @@ def register_cli(app):
         """Mostra versão atual e migrações pendentes."""
         dbp = _db_path()
         print(f"Database: {dbp}")
-        with sqlite3.connect(dbp) as conn:
-            conn.row_factory = sqlite3.Row
+        with _connect() as conn:
             _ensure_table(conn)
             all_migs = _list_migration_files()
             applied = _applied_versions(conn)
@@ -59,8 +90,7 @@ def register_cli(app):
     @app.cli.command("db-history")
     def db_history():
         """Lista histórico de migrações aplicadas."""
-        with sqlite3.connect(_db_path()) as conn:
-            conn.row_factory = sqlite3.Row
+        with _connect() as conn:
             _ensure_table(conn)
             rows = conn.execute("SELECT version, name, applied_at FROM schema_migrations ORDER BY applied_at").fetchall()
             if not rows:
@@ -76,24 +106,30 @@ def register_cli(app):
         if not migs:
             print("Nenhuma migração encontrada em migrations/.")
             return
-        with sqlite3.connect(_db_path()) as conn:
-            conn.row_factory = sqlite3.Row
+        with _connect() as conn:
             _ensure_table(conn)
             applied = _applied_versions(conn)
             to_apply = [m for m in migs if m[0] not in applied]
             if not to_apply:
                 print("Nada a aplicar.")
                 return
+            # executescript() faz COMMIT antes de rodar: para aplicar tudo numa
+            # transação só (um fsync, rollback total em erro) monta um script único.
+            # WAL/synchronous/foreign_keys já vêm de _connect (fora da transação)
+            parts = ["BEGIN;"]
             for v, name, path in to_apply:
-                sql = path.read_text(encoding="utf-8")
                 print(f"Aplicando {path.name} ...")
-                try:
-                    with conn:
-                        conn.executescript(sql)
-                        conn.execute("INSERT INTO schema_migrations(version, name) VALUES (?,?)", (v, name))
-                except sqlite3.Error as e:
-                    print(f"ERRO na migração {path.name}: {e}")
-                    raise SystemExit(1)
+                parts.append(path.read_text(encoding="utf-8"))
+                parts.append(";\nINSERT INTO schema_migrations(version, name) VALUES ('%s', '%s');"
+                             % (v, name.replace("'", "''")))
+            parts.append("COMMIT;")
+            try:
+                conn.executescript("\n".join(parts))
+            except sqlite3.Error as e:
+                if conn.in_transaction:
+                    conn.rollback()
+                print(f"ERRO ao aplicar migrações (nada foi aplicado): {e}")
+                raise SystemExit(1)
             print("OK: migrações aplicadas.")
 
     @app.cli.command("db-baseline")
@@ -104,7 +140,7 @@ def register_cli(app):
         if target not in migs:
             print(f"Versão {target} não encontrada em migrations/.")
             raise SystemExit(1)
-        with sqlite3.connect(_db_path()) as conn:
+        with _connect() as conn:
             _ensure_table(conn)
             with conn:
                 conn.execute("INSERT OR IGNORE INTO schema_migrations(version, name) VALUES (?,?)", (target, migs[target]))
@@ -113,6 +149,6 @@ def register_cli(app):
     @app.cli.command("db-verify")
     def db_verify():
         """Roda PRAGMA integrity_check e exibe resultado."""
-        with sqlite3.connect(_db_path()) as conn:
+        with _connect() as conn:
             res = conn.execute("PRAGMA integrity_check").fetchone()[0]
             print(f"PRAGMA integrity_check => {res}")
\ No newline at end of file
@@ -6,7 +6,8 @@ from flask import (
     flash, g, current_app
 )
 
-from .db import query, execute
+from .db import query, execute, cached
+from .courses import get_course
 from .security import login_required, csrf_protect
 
 bp = Blueprint("notices", __name__, url_prefix="/notices")
@@ -15,22 +16,11 @@ MAX_TITLE = 200
 MAX_BODY = 5_000
 
 def _get_course(course_id: int) -> Optional[dict]:
-    return query("SELECT * FROM courses WHERE id = ?", (course_id,), one=True)
+    return get_course(course_id)
 
 def _is_instructor(user_id: int, course_id: int) -> bool:
-    return bool(query(
-        "SELECT 1 FROM course_instructors WHERE course_id=? AND user_id=?",
-        (course_id, user_id), one=True
-    ))
-
-def _is_member(user_id: int, course_id: int) -> bool:
-    return bool(query(
-        "SELECT 1 FROM course_members WHERE course_id=? AND user_id=?",
-        (course_id, user_id), one=True
-    ))
-
-def _can_view(user_id: int, course_id: int) -> bool:
-    return _is_instructor(user_id, course_id) or _is_member(user_id, course_id)
+    return cached(("is_instructor", user_id, course_id), lambda: bool(
+        query("SELECT 1 FROM course_instructors WHERE course_id=? AND user_id=?", (course_id, user_id), one=True)))
 
 @bp.get("/new/<int:course_id>")
 @login_required
@@ -77,16 +67,21 @@ def create(course_id: int):
 @bp.get("/<int:notice_id>")
 @login_required
 def detail(notice_id: int):
+    user_id = g.user["id"]
     notice = query("""
-        SELECT n.*, c.title AS course_title, c.code AS course_code
+        SELECT n.*, c.title AS course_title, c.code AS course_code,
+               EXISTS(SELECT 1 FROM course_instructors ci
+                       WHERE ci.course_id = n.course_id AND ci.user_id = ?) AS is_instr,
+               EXISTS(SELECT 1 FROM course_members cm
+                       WHERE cm.course_id = n.course_id AND cm.user_id = ?) AS is_member
         FROM notices n
         JOIN courses c ON c.id = n.course_id
         WHERE n.id = ?
-    """, (notice_id,), one=True)
+    """, (user_id, user_id, notice_id), one=True)
     if not notice:
         flash("Aviso não encontrado.", "danger")
         return redirect(url_for("courses.list_courses"))
-    if not _can_view(g.user["id"], notice["course_id"]):
+    if not (notice["is_instr"] or notice["is_member"]):
         flash("Você não tem acesso a este aviso.", "danger")
         return redirect(url_for("courses.detail", course_id=notice["course_id"]))
     return render_template("notices/detail.html", notice=notice)
\ No newline at end of file
@@ -1,10 +1,21 @@
 from __future__ import annotations
 
+import hmac
+import io
+import mimetypes
+import os
+import queue
+import re
 import secrets
+import shutil
+import sys
+import threading
 import time
+from collections import OrderedDict
 from functools import wraps
 from typing import Callable, Any
-from flask import session, request, abort, redirect, url_for, flash, current_app, g
+from urllib.parse import quote
+from flask import session, request, abort, redirect, url_for, flash, current_app, g, send_file, Response
 
 # --- CSRF ---
 
@@ -16,59 +27,210 @@ def get_csrf_token() -> str:
         session["csrf_token"] = token
     return token
 
+_UNSAFE_METHODS = frozenset(("POST", "PUT", "PATCH", "DELETE"))
+
 def csrf_protect(view: Callable[..., Any]) -> Callable[..., Any]:
-    """Decorator que exige um token CSRF válido para métodos mutáveis."""
-    @wraps(view)
-    def wrapper(*args, **kwargs):
-        if request.method in ("POST", "PUT", "PATCH", "DELETE"):
-            form_token = request.form.get("csrf_token") or request.headers.get("X-CSRF-Token")
-            if not form_token or form_token != session.get("csrf_token"):
-                abort(400, description="CSRF token inválido ou ausente.")
-        return view(*args, **kwargs)
-    return wrapper
+    """Marca a view: exige token CSRF válido para métodos mutáveis (checado em init_app)."""
+    view._csrf_required = True
+    return view
+
+def _check_csrf() -> None:
+    form_token = request.form.get("csrf_token") or request.headers.get("X-CSRF-Token")
+    sess_token = session.get("csrf_token")
+    # comparação em tempo constante; em bytes porque str não-ASCII levantaria TypeError
+    if not form_token or not sess_token or not hmac.compare_digest(form_token.encode(), sess_token.encode()):
+        abort(400, description="CSRF token inválido ou ausente.")
+
+# --- Uploads ---
+
+_UNSAFE_FILENAME_RE = re.compile(r"[^A-Za-z0-9._-]")
+MAX_FILENAME = 200
+MAX_EXT = 16  # com o ponto
+
+def safe_filename(filename: str) -> str:
+    """Versão enxuta do secure_filename: um único regex com allowlist ASCII.
+    Separadores e demais caracteres viram '_'; pontos nas pontas são removidos.
+    Trunca em MAX_FILENAME preservando a extensão (até MAX_EXT; maior que isso não
+    conta como extensão). Pode retornar "" (trate como nome inválido).
+    """
+    name = _UNSAFE_FILENAME_RE.sub("_", filename).strip("._")
+    if len(name) > MAX_FILENAME:
+        stem, ext = os.path.splitext(name)
+        if len(ext) > MAX_EXT:  # "extensão" enorme: não é extensão, corta o nome inteiro
+            stem, ext = name, ""
+        # de novo: o corte pode deixar "." ou "_" nas pontas
+        name = (stem[:MAX_FILENAME - len(ext)] + ext).strip("._")
+    return name
+
+def is_under_uploads(path) -> bool:
+    """Confere se `path` (montado a partir de UPLOAD_FOLDER) fica dentro de uploads/.
+    abspath normaliza ".." sem tocar o disco; os dois lados ficam na mesma forma,
+    então um uploads/ que seja symlink continua casando.
+    """
+    base = current_app.config["UPLOAD_FOLDER_ABS"]
+    return os.path.abspath(path).startswith(base + os.sep)
+
+_SENDFILE_TO_FILE = hasattr(os, "sendfile") and sys.platform.startswith("linux")
+
+# DONTNEED só descarta páginas limpas (não inicia writeback): antes é preciso
+# fdatasync. As duas coisas rodam numa thread de fundo, fora do request.
+_CAN_DROP_CACHE = hasattr(os, "posix_fadvise") and hasattr(os, "fdatasync")
+_DROP_CACHE_QUEUE: queue.SimpleQueue | None = None
+_DROP_CACHE_LOCK = threading.Lock()
+
+def _drop_cache_worker(q: queue.SimpleQueue) -> None:
+    while True:
+        path = q.get()
+        try:
+            fd = os.open(path, os.O_RDONLY)
+        except OSError:  # já apagado/substituído
+            continue
+        try:
+            os.fdatasync(fd)
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+        except OSError:
+            pass
+        finally:
+            os.close(fd)
+
+def _drop_page_cache(path) -> None:
+    global _DROP_CACHE_QUEUE
+    if _DROP_CACHE_QUEUE is None:
+        with _DROP_CACHE_LOCK:
+            if _DROP_CACHE_QUEUE is None:
+                q: queue.SimpleQueue = queue.SimpleQueue()
+                threading.Thread(target=_drop_cache_worker, args=(q,),
+                                 name="ipelms-drop-cache", daemon=True).start()
+                _DROP_CACHE_QUEUE = q
+    _DROP_CACHE_QUEUE.put(os.fspath(path))
+
+def save_upload(file, dest_path, drop_cache: bool = False) -> None:
+    """Copia o upload para o destino sem carregá-lo inteiro em memória.
+    Uploads grandes já vêm do Werkzeug num arquivo temporário: aí a cópia é feita
+    dentro do kernel (sendfile); os pequenos (em memória) vão em blocos de 1 MiB.
+    drop_cache: tira as páginas do arquivo do page cache (em segundo plano), para
+    não expulsarem o banco e os templates; o arquivo raramente é relido logo.
+    """
+    src = file.stream
+    src_fd = None
+    # SpooledTemporaryFile ainda em memória: fileno() forçaria a gravação em disco
+    if getattr(src, "_rolled", True):
+        try:
+            src_fd = src.fileno()
+        except (AttributeError, OSError, io.UnsupportedOperation):
+            src_fd = None
+    with open(dest_path, "wb") as out:
+        copied = False
+        # sendfile arquivo->arquivo só no Linux (macOS/BSD exigem socket: ENOTSOCK)
+        if src_fd is not None and _SENDFILE_TO_FILE:
+            start = offset = src.tell()
+            try:
+                while True:
+                    sent = os.sendfile(out.fileno(), src_fd, offset, 1024 * 1024)
+                    if not sent:
+                        break
+                    offset += sent
+                copied = True
+            except OSError:
+                # recomeça do zero pelo caminho em Python
+                src.seek(start)
+                out.seek(0)
+                out.truncate()
+        if not copied:
+            shutil.copyfileobj(src, out, length=1024 * 1024)
+    if drop_cache and _CAN_DROP_CACHE:
+        _drop_page_cache(dest_path)
+
+def send_upload(abs_path, rel_path: str):
+    """Entrega um anexo já validado (caminho dentro de uploads/).
+    Com X_ACCEL_REDIRECT_PREFIX o nginx lê o arquivo do disco (sendfile) e o
+    worker só devolve headers; senão usa send_file (X-Sendfile se USE_X_SENDFILE,
+    wsgi.file_wrapper no gunicorn), com ETag/304.
+    """
+    prefix = current_app.config.get("X_ACCEL_REDIRECT_PREFIX")
+    if not prefix:
+        # sem max_age: são arquivos privados, não devem ir para caches compartilhados
+        return send_file(abs_path, as_attachment=True, conditional=True)
+    name = os.path.basename(abs_path)
+    resp = Response(mimetype=mimetypes.guess_type(name)[0] or "application/octet-stream")
+    resp.headers["X-Accel-Redirect"] = quote(prefix.rstrip("/") + "/" + rel_path.replace(os.sep, "/"))
+    resp.headers["Content-Disposition"] = f"attachment; filename*=UTF-8''{quote(name)}"
+    return resp
 
 # --- Auth auxiliar ---
 
 def login_required(view: Callable[..., Any]) -> Callable[..., Any]:
-    """Decorator para rotas que exigem usuário autenticado.
-    Garante sessão válida e g.user carregado; caso contrário, redireciona ao login.
+    """Marca a view como restrita a usuário autenticado (checado em init_app)."""
+    view._login_required = True
+    return view
+
+def _check_login():
+    uid = session.get("user_id")
+    if not uid:
+        flash("Você precisa estar autenticado.", "warning")
+        return redirect(url_for("auth.login", next=request.path))
+    # Pode haver sessão órfã (user apagado) ou g.user não carregado
+    if not getattr(g, "user", None):
+        session.clear()
+        flash("Sua sessão expirou. Faça login novamente.", "warning")
+        return redirect(url_for("auth.login", next=request.path))
+    return None
+
+def init_app(app) -> None:
+    """Checa login/CSRF das views marcadas num único before_request.
+    As marcas são lidas da view a cada request (não fica lista pré-calculada
+    que uma rota registrada depois deixaria desprotegida). Registre depois dos
+    blueprints: roda após o hook que carrega g.user.
     """
-    @wraps(view)
-    def wrapped(*args, **kwargs):
-        uid = session.get("user_id")
-        if not uid:
-            flash("Você precisa estar autenticado.", "warning")
-            return redirect(url_for("auth.login", next=request.path))
-        # Pode haver sessão órfã (user apagado) ou g.user não carregado
-        if not getattr(g, "user", None):
-            session.clear()
-            flash("Sua sessão expirou. Faça login novamente.", "warning")
-            return redirect(url_for("auth.login", next=request.path))
-        return view(*args, **kwargs)
-    return wrapped
+    view_functions = app.view_functions
+
+    @app.before_request
+    def _check_login_and_csrf():
+        fn = view_functions.get(request.endpoint)
+        if fn is None:
+            return None
+        method = request.method
+        if method != "OPTIONS" and getattr(fn, "_login_required", False):
+            resp = _check_login()
+            if resp is not None:
+                return resp
+        if method in _UNSAFE_METHODS and getattr(fn, "_csrf_required", False):
+            _check_csrf()
+        return None
 
 # --- Rate limiting simples (em memória) ---
 
+# LRU limitado: IPs/endpoints novos expulsam os mais antigos (memória não cresce
+# sem limite sob ataque). monotonic() não anda para trás se o relógio for ajustado.
+_RATE_LIMIT_MAX = 50_000
+_RATE_LIMIT_STORE: OrderedDict[str, list] = OrderedDict()  # key -> [count, window_start]
+_RATE_LIMIT_LOCK = threading.Lock()
+
 def rate_limit(max_requests: int = 8, window_seconds: int = 60) -> Callable[[Callable[..., Any]], Callable[..., Any]]:
     """
-    Limita chamadas por (IP + endpoint) dentro de uma janela deslizante.
-    Armazena contadores em current_app.config['_RATE_LIMIT_STORE'] (reset ao reiniciar).
+    Limita chamadas por (IP + endpoint) dentro de uma janela fixa.
+    Contadores ficam em memória, por processo (reset ao reiniciar).
     """
     def decorator(view: Callable[..., Any]) -> Callable[..., Any]:
         @wraps(view)
         def wrapper(*args, **kwargs):
             ip = request.headers.get("X-Forwarded-For", request.remote_addr) or "unknown"
             key = f"{ip}:{request.endpoint or 'unknown'}"
-            store = current_app.config.setdefault("_RATE_LIMIT_STORE", {})
-            now = time.time()
-            data = store.get(key)
-            if not data or now - data["window_start"] > window_seconds:
-                store[key] = {"count": 1, "window_start": now}
-            else:
-                data["count"] += 1
-                if data["count"] > max_requests:
-                    current_app.logger.warning("Rate limit excedido: key=%s endpoint=%s", key, request.endpoint)
-                    abort(429, description="Muitas requisições; tente novamente em breve.")
+            now = time.monotonic()
+            with _RATE_LIMIT_LOCK:
+                data = _RATE_LIMIT_STORE.get(key)
+                if not data or now - data[1] > window_seconds:
+                    if data is None and len(_RATE_LIMIT_STORE) >= _RATE_LIMIT_MAX:
+                        _RATE_LIMIT_STORE.popitem(last=False)
+                    _RATE_LIMIT_STORE[key] = [1, now]
+                    exceeded = False
+                else:
+                    data[0] += 1
+                    exceeded = data[0] > max_requests
+                _RATE_LIMIT_STORE.move_to_end(key)
+            if exceeded:
+                current_app.logger.warning("Rate limit excedido: key=%s endpoint=%s", key, request.endpoint)
+                abort(429, description="Muitas requisições; tente novamente em breve.")
             return view(*args, **kwargs)
         return wrapper
-    return decorator
\ No newline at end of file
+    return decorator
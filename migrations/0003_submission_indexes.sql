@@ -0,0 +1,19 @@
+-- Índices compostos para os caminhos quentes de envios
+-- (course_members/course_instructors já têm PRIMARY KEY (course_id, user_id))
+
+PRAGMA foreign_keys = ON;
+
+-- o schema antigo não impedia envios duplicados (SELECT-e-INSERT concorrentes):
+-- mantém só o mais recente (MAX(id)) de cada par antes de criar o índice único.
+-- Os anexos das linhas removidas ficam órfãos em uploads/ (não são apagados aqui).
+DELETE FROM submissions
+ WHERE id NOT IN (SELECT MAX(id) FROM submissions GROUP BY assignment_id, student_id);
+
+-- um envio por aluno/tarefa; atende "SELECT ... WHERE assignment_id=? AND student_id=?"
+CREATE UNIQUE INDEX IF NOT EXISTS idx_submissions_assignment_student ON submissions(assignment_id, student_id);
+-- listagem do instrutor (WHERE assignment_id=? ORDER BY submitted_at DESC)
+CREATE INDEX IF NOT EXISTS idx_submissions_assignment_submitted ON submissions(assignment_id, submitted_at DESC);
+-- coberto pelos dois acima (mesmo prefixo)
+DROP INDEX IF EXISTS idx_submissions_assignment;
+
+ANALYZE;
@@ -90,6 +90,7 @@ CREATE INDEX idx_lessons_course           ON lessons(course_id);
 CREATE INDEX idx_notices_course           ON notices(course_id);
 CREATE INDEX idx_assignments_course       ON assignments(course_id);
 CREATE INDEX idx_submissions_student      ON submissions(student_id);
-CREATE INDEX idx_submissions_assignment   ON submissions(assignment_id);
+CREATE UNIQUE INDEX idx_submissions_assignment_student   ON submissions(assignment_id, student_id);
+CREATE INDEX idx_submissions_assignment_submitted        ON submissions(assignment_id, submitted_at DESC);
 CREATE INDEX idx_course_members_user      ON course_members(user_id);
 CREATE INDEX idx_course_instr_user        ON course_instructors(user_id);
\ No newline at end of file